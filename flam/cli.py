@@ -1,93 +1,44 @@
+# flam/cli.py
+# Entry point for `queuectl` / `python -m flam.cli`.
+#
+# Importing Typer (click + rich + command introspection) dominates startup, so the
+# hot, script-friendly commands (enqueue, enqueue-many, status, logs) are parsed with
+# argparse here and never import it. Everything else, and any --help, goes to the Typer app in
+# flam/commands.py.
+import argparse
 import os
-import multiprocessing
-import typer
+import re
+import sys
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 
-from flam.db import (
-    init_db,
-    enqueue_job,
-    get_job_counts,
-    list_jobs_by_state,
-    list_dead_jobs,
-    retry_dead_job,
-    now_iso,
-    get_conn
-)
-from flam.worker import worker_loop
+PID_FILE = "workers.pid"
 
-# ============================================================
-# MAIN APP + CONFIG SUBCOMMAND GROUP
-# ============================================================
-
-app = typer.Typer(help="QueueCTL - Background job queue system")
-config_app = typer.Typer(help="Manage QueueCTL configuration")
-app.add_typer(config_app, name="config")
-
-# ============================================================
-# CONFIG COMMANDS (PROPER SUBCOMMAND STYLE)
-# ============================================================
-
-from flam.config import load_config, save_config
-
-
-@config_app.command("show")
-def config_show():
-    """Show full configuration."""
-    cfg = load_config()
-    typer.echo("Current Configuration:")
-    for k, v in cfg.items():
-        typer.echo(f"- {k}: {v}")
-
-
-@config_app.command("get")
-def config_get(key: str):
-    """Get a configuration value."""
-    cfg = load_config()
-    if key not in cfg:
-        typer.echo(f"Unknown config key: {key}")
-        raise typer.Exit(1)
-    typer.echo(f"{key} = {cfg[key]}")
-
-
-@config_app.command("set")
-def config_set(key: str, value: str):
-    """Set a configuration value."""
-    cfg = load_config()
-
-    # try converting to number
-    try:
-        if "." in value:
-            value = float(value)
-        else:
-            value = int(value)
-    except:
-        pass
-
-    cfg[key] = value
-    save_config(cfg)
-    typer.echo(f"Updated {key} = {value}")
+CANONICAL_RUN_AT = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z")
 
-# ============================================================
-# INIT DB
-# ============================================================
+# enqueue-many lines may start with their own "--timeout N" / "--priority N"
+LINE_OPTION = re.compile(r"--(timeout|priority)[ =](-?[0-9]+)\s+")
 
-@app.command("init")
-def init():
-    """Initialize database + config."""
-    init_db()
-    typer.echo("Database initialized (or already up-to-date).")
+FAST_COMMANDS = ("enqueue", "enqueue-many", "status", "logs")
 
 # ============================================================
 # UTIL
 # ============================================================
 
+@lru_cache(maxsize=128)
 def parse_run_at(run_at: str):
     """Parse ISO-8601 UTC timestamps."""
     if not run_at:
         return None
     try:
+        # Common case: already canonical (YYYY-MM-DDTHH:MM:SSZ), so validating it is enough
+        if CANONICAL_RUN_AT.fullmatch(run_at):
+            datetime.fromisoformat(run_at[:-1])  # range checks (month 13, second 60, ...)
+            return run_at
+
         if run_at.endswith("Z"):
-            dt = datetime.fromisoformat(run_at.replace("Z", "+00:00"))
+            # Appending the offset (rather than overriding tzinfo) rejects "Z" after another offset
+            dt = datetime.fromisoformat(run_at[:-1] + "+00:00")
         else:
             dt = datetime.fromisoformat(run_at)
             if dt.tzinfo is None:
@@ -97,21 +48,17 @@ def parse_run_at(run_at: str):
         raise ValueError(f"Invalid run_at format. Use ISO like 2025-12-01T10:00:00Z. Error: {e}")
 
 # ============================================================
-# ENQUEUE
+# FAST-PATH COMMANDS (shared with the Typer app)
 # ============================================================
 
-@app.command("enqueue")
-def enqueue(
-    command: str,
-    timeout: int = typer.Option(30),
-    priority: int = typer.Option(0),
-    run_at: str = typer.Option(None),
-    delay: int = typer.Option(None)
-):
+def run_enqueue(command, timeout=30, priority=0, run_at=None, delay=None):
     """Enqueue a new job."""
+    from flam.db import enqueue_job
+    from flam.utils import notify_workers
+
     if run_at and delay is not None:
-        typer.echo("Use either --run-at or --delay, not both.", err=True)
-        raise typer.Exit(2)
+        print("Use either --run-at or --delay, not both.", file=sys.stderr)
+        raise SystemExit(2)
 
     next_run_iso = None
 
@@ -122,214 +69,125 @@ def enqueue(
         next_run_iso = dt.replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
 
     job_id = enqueue_job(command, timeout, priority, next_run_iso)
+    notify_workers()
 
-    typer.echo(
+    print(
         f"Enqueued job {job_id}: {command} "
         f"(run_at={next_run_iso or 'ASAP'}, timeout={timeout}s, priority={priority})"
     )
 
-# ============================================================
-# WORKER START / STOP
-# ============================================================
 
-@app.command("worker-start")
-def worker_start(count: int = typer.Option(1)):
-    """Start worker processes."""
-    from flam.db import recover_stuck_jobs
+def parse_job_line(line, timeout, priority):
+    """Split an enqueue-many line into (command, timeout, priority); its options override the defaults."""
+    options = {"timeout": timeout, "priority": priority}
+    while match := LINE_OPTION.match(line):
+        options[match.group(1)] = int(match.group(2))
+        line = line[match.end():]
+    return line, options["timeout"], options["priority"]
 
-    stuck = recover_stuck_jobs(timeout_seconds=60)
-    if stuck:
-        typer.echo(f"Recovered stuck jobs: {', '.join(stuck)}")
-    else:
-        typer.echo("No stuck jobs found.")
 
-    if os.path.exists("stop.flag"):
-        os.remove("stop.flag")
+def run_enqueue_many(path, timeout=30, priority=0):
+    """Enqueue one job per non-blank line of a file, in a single transaction."""
+    from flam.db import enqueue_jobs_bulk
+    from flam.utils import notify_workers
 
-    procs = []
-    for _ in range(count):
-        p = multiprocessing.Process(target=worker_loop)
-        p.start()
-        procs.append(p)
+    if not os.path.exists(path):
+        print(f"File not found: {path}", file=sys.stderr)
+        raise SystemExit(2)
 
-    typer.echo(f"Started {count} worker(s). Press Ctrl+C to stop.")
+    with open(path, "r") as f:
+        jobs = [parse_job_line(line.strip(), timeout, priority) for line in f if line.strip()]
 
-    try:
-        for p in procs:
-            p.join()
-    except KeyboardInterrupt:
-        typer.echo("\nStopping workers gracefully...")
-        for p in procs:
-            p.terminate()
+    if not jobs:
+        print(f"No commands found in {path}")
+        return
 
+    job_ids = enqueue_jobs_bulk([(cmd, t, prio, None) for cmd, t, prio in jobs])
+    notify_workers()
 
-@app.command("worker-stop")
-def worker_stop():
-    """Signal workers to stop."""
-    with open("stop.flag", "w") as f:
-        f.write("1")
-    typer.echo("Stop signal sent. Workers will stop soon.")
+    for job_id, (cmd, _, _) in zip(job_ids, jobs):
+        print(f"Enqueued job {job_id}: {cmd}")
+    print(f"Enqueued {len(job_ids)} job(s) (default timeout={timeout}s, priority={priority})")
 
-# ============================================================
-# STATUS
-# ============================================================
 
-@app.command("status")
-def status():
+def run_status():
     """Show counts of job states."""
+    from flam.db import get_job_counts
+
     counts = get_job_counts()
-    typer.echo("\nJob Status Summary")
+    print("\nJob Status Summary")
     for state in ["pending", "processing", "completed", "dead"]:
-        typer.echo(f"  {state:<12} : {counts.get(state, 0)}")
-    typer.echo("")
+        print(f"  {state:<12} : {counts.get(state, 0)}")
+    print("")
 
-# ============================================================
-# LIST JOBS
-# ============================================================
 
-@app.command("list")
-def list_jobs(state: str = typer.Option("pending")):
-    """List jobs by state."""
-    rows = list_jobs_by_state(state)
-    if not rows:
-        typer.echo(f"No jobs found in state '{state}'")
-        return
-
-    typer.echo(f"\nJobs in state '{state}':")
-    for r in rows:
-        next_run = r["next_run_at"] if "next_run_at" in r.keys() else None
-    
-        msg = (
-            f"{r['id']} | {r['command']} "
-            f"| attempts={r['attempts']}/{r['max_retries']} "
-            f"| run_at={next_run or 'ASAP'}"
-        )
-    
-        if r["last_error"]:
-            msg += f" | error={r['last_error'][:60]}"
-    
-        typer.echo(msg)
-
-
-# ============================================================
-# DLQ
-# ============================================================
-
-@app.command("dlq")
-def dlq(action: str = typer.Argument("list"), job_id: str = typer.Argument(None)):
-    """View or retry dead jobs."""
-    if action == "list":
-        rows = list_dead_jobs()
-        if not rows:
-            typer.echo("No dead jobs.")
-            return
-
-        typer.echo("\nDead Letter Queue:")
-        for r in rows:
-            typer.echo(
-                f"{r['id']} | {r['command']} "
-                f"| attempts={r['attempts']} | error={r['last_error'][:80]}"
-            )
-        return
-
-    if action == "retry" and job_id:
-        ok = retry_dead_job(job_id)
-        if ok:
-            typer.echo(f"Retried job {job_id} (moved back to pending).")
-        else:
-            typer.echo("Job not found.")
-        return
-
-    typer.echo("Usage: queuectl dlq list | queuectl dlq retry <job_id>")
-
-# ============================================================
-# LOGS
-# ============================================================
-
-@app.command("logs")
-def logs(job_id: str):
+def run_logs(job_id):
     """Show job logs."""
+    from flam.db import get_conn
+
     with get_conn() as conn:
         row = conn.execute(
             "SELECT id, command, state, last_output FROM jobs WHERE id = ?",
             (job_id,)
         ).fetchone()
 
-        if not row:
-            typer.echo("Job not found")
-            raise typer.Exit()
+    if not row:
+        print("Job not found")
+        return
 
-        typer.echo(f"Logs for job {job_id}")
-        typer.echo(f"Command: {row['command']}")
-        typer.echo(f"State:   {row['state']}")
-        typer.echo("----- OUTPUT BEGIN -----")
-        typer.echo(row["last_output"] or "(no output)")
-        typer.echo("----- OUTPUT END -----")
+    print(f"Logs for job {job_id}")
+    print(f"Command: {row['command']}")
+    print(f"State:   {row['state']}")
+    print("----- OUTPUT BEGIN -----")
+    print(row["last_output"] or "(no output)")
+    print("----- OUTPUT END -----")
 
 # ============================================================
-# METRICS
+# ENTRY POINT
 # ============================================================
 
-@app.command("metrics")
-def metrics():
-    """Show overall system metrics."""
-    with get_conn() as conn:
+def build_fast_parser():
+    parser = argparse.ArgumentParser(prog="queuectl", add_help=False)
+    sub = parser.add_subparsers(dest="cmd", required=True)
 
-        total = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
-        pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='pending'").fetchone()[0]
-        processing = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='processing'").fetchone()[0]
-        completed = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='completed'").fetchone()[0]
-        dead = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='dead'").fetchone()[0]
-
-        scheduled = conn.execute(
-            "SELECT COUNT(*) FROM jobs WHERE state='pending' AND next_run_at > ?",
-            (now_iso(),)
-        ).fetchone()[0]
-
-        total_retries = conn.execute("SELECT SUM(attempts) FROM jobs").fetchone()[0] or 0
-        avg_retries = conn.execute("SELECT AVG(attempts) FROM jobs").fetchone()[0] or 0
-
-        avg_duration = conn.execute("SELECT AVG(duration_seconds) FROM jobs").fetchone()[0] or 0
-        max_duration = conn.execute("SELECT MAX(duration_seconds) FROM jobs").fetchone()[0] or 0
-        min_duration = conn.execute("SELECT MIN(duration_seconds) FROM jobs WHERE duration_seconds > 0").fetchone()[0] or 0
-
-    typer.echo("\n📊 Queue Metrics")
-    typer.echo("==========================")
-    typer.echo(f"Total Jobs:        {total}")
-    typer.echo(f"  Pending:         {pending}")
-    typer.echo(f"  Processing:      {processing}")
-    typer.echo(f"  Completed:       {completed}")
-    typer.echo(f"  Dead (DLQ):      {dead}")
-    typer.echo("")
-    typer.echo(f"Scheduled Jobs:    {scheduled}")
-    typer.echo("")
-    typer.echo(f"Total Retries:     {total_retries}")
-    typer.echo(f"Avg Retries/Job:   {avg_retries:.2f}")
-    typer.echo("")
-    typer.echo(f"Avg Duration:      {avg_duration:.3f}s")
-    typer.echo(f"Fastest Job:       {min_duration:.3f}s")
-    typer.echo(f"Slowest Job:       {max_duration:.3f}s")
-    typer.echo("==========================")
+    p = sub.add_parser("enqueue", add_help=False)
+    p.add_argument("command")
+    p.add_argument("--timeout", type=int, default=30)
+    p.add_argument("--priority", type=int, default=0)
+    p.add_argument("--run-at", dest="run_at", default=None)
+    p.add_argument("--delay", type=int, default=None)
 
-# ============================================================
-# DASHBOARD
-# ============================================================
+    p = sub.add_parser("enqueue-many", add_help=False)
+    p.add_argument("--from-file", dest="from_file", required=True)
+    p.add_argument("--timeout", type=int, default=30)
+    p.add_argument("--priority", type=int, default=0)
 
-@app.command("dashboard")
-def dashboard():
-    """Start the QueueCTL dashboard."""
-    import uvicorn
-    typer.echo("Starting dashboard at http://localhost:8000 ...")
-    uvicorn.run("flam.dashboard:app", host="127.0.0.1", port=8000, reload=False)
+    sub.add_parser("status", add_help=False)
 
-# ============================================================
-# VERSION
-# ============================================================
+    p = sub.add_parser("logs", add_help=False)
+    p.add_argument("job_id")
+
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] in FAST_COMMANDS and not any(a in ("--help", "-h") for a in argv):
+        args = build_fast_parser().parse_args(argv)
+        if args.cmd == "enqueue":
+            run_enqueue(args.command, args.timeout, args.priority, args.run_at, args.delay)
+        elif args.cmd == "enqueue-many":
+            run_enqueue_many(args.from_file, args.timeout, args.priority)
+        elif args.cmd == "status":
+            run_status()
+        else:
+            run_logs(args.job_id)
+        return
 
-@app.command("version")
-def version():
-    typer.echo("QueueCTL version 0.0.1")
+    from flam.commands import app
+    app(args=argv, prog_name="queuectl")
 
 
 if __name__ == "__main__":
-    app()
+    main()
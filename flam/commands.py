@@ -0,0 +1,409 @@
+# flam/commands.py
+# Full Typer CLI. flam.cli.main() only imports this module for commands
+# that are not on its argparse fast path (see flam/cli.py).
+import os
+import signal
+import typer
+
+from flam.cli import PID_FILE, run_enqueue, run_enqueue_many, run_status, run_logs
+from flam.db import (
+    init_db,
+    compact_db,
+    get_aggregate_metrics,
+    list_jobs_by_state,
+    list_dead_jobs,
+    retry_dead_job,
+)
+
+# ============================================================
+# MAIN APP + CONFIG SUBCOMMAND GROUP
+# ============================================================
+
+app = typer.Typer(help="QueueCTL - Background job queue system")
+config_app = typer.Typer(help="Manage QueueCTL configuration")
+app.add_typer(config_app, name="config")
+
+# ============================================================
+# CONFIG COMMANDS (PROPER SUBCOMMAND STYLE)
+# ============================================================
+
+from flam.config import load_config, save_config
+
+
+@config_app.command("show")
+def config_show():
+    """Show full configuration."""
+    cfg = load_config()
+    typer.echo("Current Configuration:")
+    for k, v in cfg.items():
+        typer.echo(f"- {k}: {v}")
+
+
+@config_app.command("get")
+def config_get(key: str):
+    """Get a configuration value."""
+    cfg = load_config()
+    if key not in cfg:
+        typer.echo(f"Unknown config key: {key}")
+        raise typer.Exit(1)
+    typer.echo(f"{key} = {cfg[key]}")
+
+
+@config_app.command("set")
+def config_set(key: str, value: str):
+    """Set a configuration value."""
+    cfg = load_config()
+
+    # try converting to number
+    try:
+        if "." in value:
+            value = float(value)
+        else:
+            value = int(value)
+    except:
+        pass
+
+    cfg[key] = value
+    save_config(cfg)
+    typer.echo(f"Updated {key} = {value}")
+
+# ============================================================
+# INIT DB
+# ============================================================
+
+@app.command("init")
+def init():
+    """Initialize database + config."""
+    init_db()
+    typer.echo("Database initialized (or already up-to-date).")
+
+
+@app.command("compact")
+def compact():
+    """VACUUM the database and truncate its WAL file."""
+    compact_db()
+    typer.echo("Database compacted.")
+
+# ============================================================
+# ENQUEUE
+# ============================================================
+
+@app.command("enqueue")
+def enqueue(
+    command: str,
+    timeout: int = typer.Option(30),
+    priority: int = typer.Option(0),
+    run_at: str = typer.Option(None),
+    delay: int = typer.Option(None)
+):
+    """Enqueue a new job."""
+    run_enqueue(command, timeout, priority, run_at, delay)
+
+
+@app.command("enqueue-many")
+def enqueue_many(
+    from_file: str = typer.Option(..., "--from-file"),
+    timeout: int = typer.Option(30),
+    priority: int = typer.Option(0)
+):
+    """Enqueue one job per line of a file in a single transaction."""
+    run_enqueue_many(from_file, timeout, priority)
+
+
+@app.command("enqueue-file")
+def enqueue_file(
+    path: str,
+    timeout: int = typer.Option(30),
+    priority: int = typer.Option(0)
+):
+    """Same as enqueue-many --from-file PATH."""
+    run_enqueue_many(path, timeout, priority)
+
+# ============================================================
+# WORKER START / STOP
+# ============================================================
+
+def lock_pid_file():
+    """Open PID_FILE and take its exclusive lock; None if another worker-start has it."""
+    import fcntl
+
+    fd = os.open(PID_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def live_worker_pids():
+    """PIDs from PID_FILE if its worker-start (or one of its workers) still holds the lock, else None."""
+    import fcntl
+
+    with open(PID_FILE, "r") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return [int(line) for line in f if line.strip()]
+        # We got the lock, so no live owner
+        return None
+
+
+@app.command("worker-start")
+def worker_start(count: int = typer.Option(1)):
+    """Start worker processes."""
+    import multiprocessing
+    from flam.db import recover_stuck_jobs, close_conn
+    from flam.utils import serve_wakeups, wakeup_port
+    from flam.worker import worker_loop
+
+    # Run schema migrations once here rather than racing in every worker
+    init_db()
+
+    stuck = recover_stuck_jobs(timeout_seconds=60)
+    if stuck:
+        typer.echo(f"Recovered stuck jobs: {', '.join(stuck)}")
+    else:
+        typer.echo("No stuck jobs found.")
+
+    if os.path.exists("stop.flag"):
+        os.remove("stop.flag")
+
+    # Workers open their own connections; never hand ours across fork()
+    close_conn()
+
+    # fork lets workers inherit the already-imported modules instead of
+    # booting a fresh interpreter per worker (spawn is the only option on Windows)
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    ctx = multiprocessing.get_context(start_method)
+
+    # POSIX: worker-stop sends SIGTERM to the PIDs in PID_FILE and each worker exits
+    # after its current job. Windows has no SIGTERM delivery, so workers there keep
+    # polling stop.flag.
+    use_signals = os.name != "nt"
+
+    pid_fd = None
+    if use_signals:
+        # Forked workers inherit this until worker_loop installs its handler, so a
+        # wake-up that arrives early can't kill them (SIGUSR1's default action)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+        # The lock on PID_FILE is held for as long as this process or any worker
+        # (which inherit the descriptor) is alive; worker-stop only trusts a locked file
+        pid_fd = lock_pid_file()
+        if pid_fd is None:
+            typer.echo(
+                f"Another worker-start in this directory holds {PID_FILE}; "
+                "worker-stop will not reach these workers.",
+                err=True,
+            )
+
+    procs = []
+    for _ in range(count):
+        p = ctx.Process(target=worker_loop, args=(use_signals,))
+        p.start()
+        procs.append(p)
+
+    if pid_fd is not None:
+        os.ftruncate(pid_fd, 0)
+        os.write(pid_fd, "\n".join(str(p.pid) for p in procs).encode())
+
+    if use_signals:
+        stopping = False
+
+        def request_stop(signum, frame):
+            nonlocal stopping
+            if stopping:
+                # Second signal: don't wait for running jobs
+                for p in procs:
+                    p.kill()
+                return
+            stopping = True
+            typer.echo("\nStopping workers gracefully...")
+            for p in procs:
+                if p.is_alive():
+                    os.kill(p.pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        def wake_workers():
+            for p in procs:
+                if p.is_alive():
+                    os.kill(p.pid, signal.SIGUSR1)
+
+        # Enqueues ping this port; without it workers still find jobs by polling
+        if not serve_wakeups(wake_workers):
+            typer.echo(
+                f"Wake-up port {wakeup_port()} is in use; these workers will pick up "
+                "new jobs on their next poll.",
+                err=True,
+            )
+
+    typer.echo(f"Started {count} worker(s). Press Ctrl+C to stop.")
+
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        typer.echo("\nStopping workers gracefully...")
+        for p in procs:
+            p.terminate()
+    finally:
+        if pid_fd is not None:
+            os.remove(PID_FILE)
+            os.close(pid_fd)
+
+
+@app.command("worker-stop")
+def worker_stop():
+    """Signal workers to stop."""
+    if os.name != "nt" and os.path.exists(PID_FILE):
+        pids = live_worker_pids()
+        if pids is None:
+            # Nobody holds the lock: worker-start died without cleaning up, and the
+            # PIDs may already belong to unrelated processes
+            os.remove(PID_FILE)
+            typer.echo(f"Removed stale {PID_FILE}.")
+            pids = []
+
+        signalled = []
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                signalled.append(str(pid))
+            except OSError:
+                pass
+
+        if signalled:
+            typer.echo(f"Stop signal sent to worker(s) {', '.join(signalled)}. They will finish their current job and exit.")
+            return
+
+    with open("stop.flag", "w") as f:
+        f.write("1")
+    typer.echo("Stop signal sent. Workers will stop soon.")
+
+# ============================================================
+# STATUS
+# ============================================================
+
+@app.command("status")
+def status():
+    """Show counts of job states."""
+    run_status()
+
+# ============================================================
+# LIST JOBS
+# ============================================================
+
+@app.command("list")
+def list_jobs(state: str = typer.Option("pending")):
+    """List jobs by state."""
+    rows = list_jobs_by_state(state)
+    if not rows:
+        typer.echo(f"No jobs found in state '{state}'")
+        return
+
+    typer.echo(f"\nJobs in state '{state}':")
+    for r in rows:
+        next_run = r["next_run_at"] if "next_run_at" in r.keys() else None
+    
+        msg = (
+            f"{r['id']} | {r['command']} "
+            f"| attempts={r['attempts']}/{r['max_retries']} "
+            f"| run_at={next_run or 'ASAP'}"
+        )
+    
+        if r["last_error"]:
+            msg += f" | error={r['last_error'][:60]}"
+    
+        typer.echo(msg)
+
+
+# ============================================================
+# DLQ
+# ============================================================
+
+@app.command("dlq")
+def dlq(action: str = typer.Argument("list"), job_id: str = typer.Argument(None)):
+    """View or retry dead jobs."""
+    if action == "list":
+        rows = list_dead_jobs()
+        if not rows:
+            typer.echo("No dead jobs.")
+            return
+
+        typer.echo("\nDead Letter Queue:")
+        for r in rows:
+            typer.echo(
+                f"{r['id']} | {r['command']} "
+                f"| attempts={r['attempts']} | error={r['last_error'][:80]}"
+            )
+        return
+
+    if action == "retry" and job_id:
+        ok = retry_dead_job(job_id)
+        if ok:
+            from flam.utils import notify_workers
+            notify_workers()
+            typer.echo(f"Retried job {job_id} (moved back to pending).")
+        else:
+            typer.echo("Job not found.")
+        return
+
+    typer.echo("Usage: queuectl dlq list | queuectl dlq retry <job_id>")
+
+# ============================================================
+# LOGS
+# ============================================================
+
+@app.command("logs")
+def logs(job_id: str):
+    """Show job logs."""
+    run_logs(job_id)
+
+# ============================================================
+# METRICS
+# ============================================================
+
+@app.command("metrics")
+def metrics():
+    """Show overall system metrics."""
+    m = get_aggregate_metrics()
+
+    typer.echo("\n📊 Queue Metrics")
+    typer.echo("==========================")
+    typer.echo(f"Total Jobs:        {m['total']}")
+    typer.echo(f"  Pending:         {m['pending']}")
+    typer.echo(f"  Processing:      {m['processing']}")
+    typer.echo(f"  Completed:       {m['completed']}")
+    typer.echo(f"  Dead (DLQ):      {m['dead']}")
+    typer.echo("")
+    typer.echo(f"Scheduled Jobs:    {m['scheduled']}")
+    typer.echo("")
+    typer.echo(f"Total Retries:     {m['total_retries']}")
+    typer.echo(f"Avg Retries/Job:   {m['avg_retries']:.2f}")
+    typer.echo("")
+    typer.echo(f"Avg Duration:      {m['avg_duration']:.3f}s")
+    typer.echo(f"Fastest Job:       {m['min_duration']:.3f}s")
+    typer.echo(f"Slowest Job:       {m['max_duration']:.3f}s")
+    typer.echo("==========================")
+
+# ============================================================
+# DASHBOARD
+# ============================================================
+
+@app.command("dashboard")
+def dashboard():
+    """Start the QueueCTL dashboard."""
+    import uvicorn
+    typer.echo("Starting dashboard at http://localhost:8000 ...")
+    uvicorn.run("flam.dashboard:app", host="127.0.0.1", port=8000, reload=False)
+
+# ============================================================
+# VERSION
+# ============================================================
+
+@app.command("version")
+def version():
+    typer.echo("QueueCTL version 0.0.1")
@@ -9,29 +9,57 @@ DEFAULT_CONFIG = {
     "default_timeout": 30,
     "poll_interval": 1,
     "priority_default": 0,
+    "sqlite_synchronous": "NORMAL",
+    "worker_concurrency": 1,
+    "wakeup_port": 47321,
 }
 
+# In-memory copy of config.json, invalidated when the file's mtime changes
+_cache = None
+_cache_mtime = 0
+
+
+def load_config(create=True):
+    """
+    Load configuration file, create with defaults if missing.
+    With create=False a missing file just yields the defaults, so internal reads
+    (connection pragmas, workers) never write into the working directory.
+    """
+    global _cache, _cache_mtime
 
-def load_config():
-    """Load configuration file, create with defaults if missing."""
     if not os.path.exists(CONFIG_PATH):
-        save_config(DEFAULT_CONFIG)
+        if create:
+            save_config(DEFAULT_CONFIG)
         return DEFAULT_CONFIG.copy()
 
+    st = os.stat(CONFIG_PATH)
+    if _cache is not None and st.st_mtime == _cache_mtime:
+        return _cache.copy()
+
     with open(CONFIG_PATH, "r") as f:
         try:
             cfg = json.load(f)
-        except:
+        except json.JSONDecodeError:
             cfg = {}
 
     # Fill missing keys with defaults
     for key, val in DEFAULT_CONFIG.items():
         cfg.setdefault(key, val)
 
-    return cfg
+    _cache = cfg
+    _cache_mtime = st.st_mtime
+    return cfg.copy()
 
 
 def save_config(cfg: dict):
     """Save configuration dictionary to disk."""
-    with open(CONFIG_PATH, "w") as f:
+    global _cache, _cache_mtime
+
+    # Write to a temp file and swap it in so a crash never leaves a half-written config
+    tmp_path = CONFIG_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
         json.dump(cfg, f, indent=4)
+    os.replace(tmp_path, CONFIG_PATH)
+
+    _cache = {**DEFAULT_CONFIG, **cfg}
+    _cache_mtime = os.stat(CONFIG_PATH).st_mtime
@@ -1,15 +1,39 @@
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from flam.db import get_conn, now_iso
+import html
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, Response
+from flam.db import (
+    ConnPool,
+    pivot_metrics,
+    SQL_AGGREGATE_METRICS,
+    now_ms,
+    ms_to_iso,
+)
+from flam.utils import notify_workers
 
 app = FastAPI(title="QueueCTL Dashboard")
 
 
+@app.on_event("startup")
+async def open_db():
+    # Pages unpack plain tuples from explicit column lists instead of paying
+    # sqlite3.Row name lookups per cell
+    app.state.pool = ConnPool(size=4, row_factory=None)
+    await app.state.pool.open()
+
+
+@app.on_event("shutdown")
+async def close_db():
+    await app.state.pool.close()
+
+
 # ============================================================
 #  GLOBAL CSS (modern dashboard styling)
 # ============================================================
-BASE_CSS = """
-<style>
+# Served once from /static/dashboard.css and cached by the browser,
+# so the 3s auto-refresh doesn't re-ship it with every page.
+DASHBOARD_CSS = """
     body {
         font-family: 'Inter', sans-serif;
         margin: 0;
@@ -128,52 +152,88 @@ BASE_CSS = """
         font-family: monospace;
         font-size: 14px;
     }
-</style>
 """
 
+BASE_CSS = "<link rel='stylesheet' href='/static/dashboard.css'>"
+
+
+@app.get("/static/dashboard.css")
+async def dashboard_css():
+    return Response(
+        DASHBOARD_CSS,
+        media_type="text/css",
+        headers={"Cache-Control": "public, max-age=86400"},
+    )
+
 
 # ============================================================
 #  METRICS FETCHING
 # ============================================================
-def fetch_metrics():
-    with get_conn() as conn:
-        total = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
-        pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='pending'").fetchone()[0]
-        processing = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='processing'").fetchone()[0]
-        completed = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='completed'").fetchone()[0]
-        dead = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='dead'").fetchone()[0]
-
-        scheduled = conn.execute(
-            "SELECT COUNT(*) FROM jobs WHERE state='pending' AND next_run_at > ?",
-            (now_iso(),)
-        ).fetchone()[0]
-
-        recent_jobs = conn.execute("""
+async def fetch_metrics():
+    async with app.state.pool.connection() as conn:
+        metrics = pivot_metrics(await conn.execute_fetchall(SQL_AGGREGATE_METRICS, (now_ms(),)))
+        metrics["recent"] = await conn.execute_fetchall("""
             SELECT id, command, state, attempts, duration_seconds, last_output, updated_at
             FROM jobs
-            ORDER BY updated_at DESC
+            ORDER BY updated_at_ms DESC
             LIMIT 20
-        """).fetchall()
-
-    return {
-        "total": total,
-        "pending": pending,
-        "processing": processing,
-        "completed": completed,
-        "dead": dead,
-        "scheduled": scheduled,
-        "recent": recent_jobs,
-    }
+        """)
+
+    return metrics
+
+
+async def fetch_job(job_id: str):
+    """Return (id, command, state, attempts, duration_seconds, last_output, updated_at_ms) or None."""
+    async with app.state.pool.connection() as conn:
+        async with conn.execute("""
+            SELECT id, command, state, attempts, duration_seconds, last_output, updated_at_ms
+            FROM jobs
+            WHERE id=?
+        """, (job_id,)) as cursor:
+            return await cursor.fetchone()
+
+
+# ============================================================
+#  CONDITIONAL GET (auto-refreshing pages)
+# ============================================================
+# Browsers must revalidate on every refresh, but get a bodiless 304 when unchanged
+REVALIDATE_HEADERS = {"Cache-Control": "no-cache, must-revalidate"}
+
+
+async def dashboard_etag():
+    """
+    Every write to jobs bumps jobs_version, so it changes whenever the page would.
+    The next scheduled run time is included because the Scheduled card changes
+    when a job becomes due without any row being written.
+    """
+    async with app.state.pool.connection() as conn:
+        async with conn.execute("""
+            SELECT (SELECT version FROM jobs_version),
+                   (SELECT MIN(next_run_at_ms) FROM jobs WHERE state='pending' AND next_run_at_ms > ?)
+        """, (now_ms(),)) as cursor:
+            version, next_due = await cursor.fetchone()
+    return f'W/"{version}-{next_due}"'
+
+
+def not_modified(request: Request, etag: str):
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, **REVALIDATE_HEADERS})
+    return None
 
 
 # ============================================================
 #  DASHBOARD HOME PAGE
 # ============================================================
 @app.get("/", response_class=HTMLResponse)
-def dashboard():
-    m = fetch_metrics()
+async def dashboard(request: Request):
+    etag = await dashboard_etag()
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    m = await fetch_metrics()
 
-    html = f"""
+    parts = [f"""
     <html>
     <head>
         <title>QueueCTL Dashboard</title>
@@ -215,55 +275,99 @@ def dashboard():
                 <th>Updated</th>
                 <th>View</th>
             </tr>
-    """
+    """]
 
-    for job in m["recent"]:
-        badge = f"<span class='badge {job['state']}'>{job['state']}</span>"
-        output_snip = (job["last_output"] or "").replace("\n", " ")[:40]
-        duration = f"{job['duration_seconds']:.2f}s" if job["duration_seconds"] else "-"
+    for jid, cmd, state, attempts, dur, out, updated in m["recent"]:
+        jid = html.escape(jid)
+        badge = f"<span class='badge {state}'>{state}</span>"
+        output_snip = html.escape((out or "").replace("\n", " ")[:40], quote=False)
+        duration = f"{dur:.2f}s" if dur else "-"
 
-        html += f"""
+        parts.append(f"""
             <tr>
-                <td>{job['id']}</td>
-                <td>{job['command']}</td>
+                <td>{jid}</td>
+                <td>{html.escape(cmd)}</td>
                 <td>{badge}</td>
-                <td>{job['attempts']}</td>
+                <td>{attempts}</td>
                 <td>{duration}</td>
                 <td>{output_snip}</td>
-                <td>{job['updated_at']}</td>
-                <td><a href='/job/{job["id"]}'>Open</a></td>
+                <td>{updated}</td>
+                <td><a href='/job/{jid}'>Open</a></td>
             </tr>
-        """
+        """)
 
-    html += "</table></body></html>"
-    return html
+    parts.append("</table></body></html>")
+    return HTMLResponse("".join(parts), headers={"ETag": etag, **REVALIDATE_HEADERS})
 
 
 # ============================================================
 #  LIST JOBS BY STATE
 # ============================================================
+LIST_COLUMNS = "id, command, state, attempts, updated_at"
+STATE_PAGE_LIMIT = 50
+STATE_CACHE_TTL = 3
+
+# Newest rows of every state in one window-function pass, so moving between
+# the nav links doesn't cost a query per page
+SQL_TOP_BY_STATE = f"""
+    SELECT {LIST_COLUMNS} FROM (
+        SELECT {LIST_COLUMNS},
+               ROW_NUMBER() OVER (PARTITION BY state ORDER BY updated_at_ms DESC) AS rn
+        FROM jobs
+    )
+    WHERE rn <= ?
+    ORDER BY state, rn
+"""
+
+_state_cache = {"key": None, "checked": 0.0, "rows": {}}
+
+
+async def rows_by_state(state: str):
+    """
+    Rows for one state out of the shared per-state snapshot. Within the TTL the
+    snapshot is served as-is; after that it is only rebuilt if jobs_version moved.
+    """
+    now = time.monotonic()
+
+    if now - _state_cache["checked"] >= STATE_CACHE_TTL:
+        async with app.state.pool.connection() as conn:
+            async with conn.execute("SELECT version FROM jobs_version") as cursor:
+                (key,) = await cursor.fetchone()
+
+            if key != _state_cache["key"] or not _state_cache["rows"]:
+                grouped = {}
+                for row in await conn.execute_fetchall(SQL_TOP_BY_STATE, (STATE_PAGE_LIMIT,)):
+                    grouped.setdefault(row[2], []).append(row)
+                _state_cache["key"] = key
+                _state_cache["rows"] = grouped
+
+        _state_cache["checked"] = now
+
+    return _state_cache["rows"].get(state, [])
+
+
 @app.get("/jobs/{state}", response_class=HTMLResponse)
-def list_jobs(state: str):
+async def list_jobs(state: str):
     valid = ["pending", "processing", "completed", "dead", "scheduled", "all"]
 
     if state not in valid:
-        return HTMLResponse(f"<h1>Invalid state: {state}</h1>")
-
-    with get_conn() as conn:
-        if state == "all":
-            rows = conn.execute("SELECT * FROM jobs ORDER BY updated_at DESC LIMIT 50").fetchall()
-        elif state == "scheduled":
-            rows = conn.execute(
-                "SELECT * FROM jobs WHERE next_run_at > ? ORDER BY next_run_at",
-                (now_iso(),)
-            ).fetchall()
-        else:
-            rows = conn.execute(
-                "SELECT * FROM jobs WHERE state=? ORDER BY updated_at DESC",
-                (state,)
-            ).fetchall()
-
-    html = f"""
+        return HTMLResponse(f"<h1>Invalid state: {html.escape(state)}</h1>")
+
+    if state == "all":
+        async with app.state.pool.connection() as conn:
+            rows = await conn.execute_fetchall(
+                f"SELECT {LIST_COLUMNS} FROM jobs ORDER BY updated_at_ms DESC LIMIT {STATE_PAGE_LIMIT}"
+            )
+    elif state == "scheduled":
+        async with app.state.pool.connection() as conn:
+            rows = await conn.execute_fetchall(
+                f"SELECT {LIST_COLUMNS} FROM jobs WHERE state='pending' AND next_run_at_ms > ? ORDER BY next_run_at_ms",
+                (now_ms(),)
+            )
+    else:
+        rows = await rows_by_state(state)
+
+    parts = [f"""
     <html>
     <head>{BASE_CSS}</head>
     <body>
@@ -279,89 +383,98 @@ def list_jobs(state: str):
                 <th>Updated</th>
                 <th>View</th>
             </tr>
-    """
+    """]
 
-    for j in rows:
-        badge = f"<span class='badge {j['state']}'>{j['state']}</span>"
+    for jid, cmd, job_state, attempts, updated in rows:
+        jid = html.escape(jid)
+        badge = f"<span class='badge {job_state}'>{job_state}</span>"
 
-        html += f"""
+        parts.append(f"""
             <tr>
-                <td>{j['id']}</td>
-                <td>{j['command']}</td>
+                <td>{jid}</td>
+                <td>{html.escape(cmd)}</td>
                 <td>{badge}</td>
-                <td>{j['attempts']}</td>
-                <td>{j['updated_at']}</td>
-                <td><a href='/job/{j["id"]}'>Open</a></td>
+                <td>{attempts}</td>
+                <td>{updated}</td>
+                <td><a href='/job/{jid}'>Open</a></td>
             </tr>
-        """
+        """)
 
-    html += "</table></body></html>"
-    return html
+    parts.append("</table></body></html>")
+    return "".join(parts)
 
 
 # ============================================================
 #  JOB DETAIL PAGE
 # ============================================================
 @app.get("/job/{job_id}", response_class=HTMLResponse)
-def job_detail(job_id: str):
-    with get_conn() as conn:
-        job = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+async def job_detail(job_id: str):
+    job = await fetch_job(job_id)
 
     if not job:
         return HTMLResponse("<h1>Job not found</h1>")
 
-    output = (job["last_output"] or "").replace("<", "&lt;")
+    jid, cmd, state, attempts, duration, out, _ = job
+    safe_id = html.escape(jid)
+    output = html.escape(out or "", quote=False)
 
-    html = f"""
+    page = f"""
     <html>
     <head>{BASE_CSS}</head>
     <body>
         <a href='/'>← Back</a>
-        <h1>Job {job_id}</h1>
+        <h1>Job {safe_id}</h1>
 
         <div class='cards'>
-            <div class='card'><b>Command:</b> {job['command']}</div>
-            <div class='card'><b>Status:</b> <span class='badge {job['state']}'>{job['state']}</span></div>
-            <div class='card'><b>Attempts:</b> {job['attempts']}</div>
-            <div class='card'><b>Duration:</b> {job['duration_seconds'] or "-"} s</div>
+            <div class='card'><b>Command:</b> {html.escape(cmd)}</div>
+            <div class='card'><b>Status:</b> <span class='badge {state}'>{state}</span></div>
+            <div class='card'><b>Attempts:</b> {attempts}</div>
+            <div class='card'><b>Duration:</b> {duration or "-"} s</div>
         </div>
 
         <h3>Output</h3>
         <div class="output-box">{output}</div>
 
         <br><br>
-        <a href="/job/{job_id}/retry"><button class="button">Retry Job</button></a>
-        <a href="/job/{job_id}/tail"><button class="button">Tail Logs</button></a>
+        <a href="/job/{safe_id}/retry"><button class="button">Retry Job</button></a>
+        <a href="/job/{safe_id}/tail"><button class="button">Tail Logs</button></a>
     </body></html>
     """
 
-    return HTMLResponse(html)
+    return HTMLResponse(page)
 
 
 # ============================================================
 #  RETRY JOB
 # ============================================================
 @app.get("/job/{job_id}/retry", response_class=HTMLResponse)
-def job_retry(job_id: str):
-    with get_conn() as conn:
-        job = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
-        if not job:
-            return HTMLResponse("Job not found")
-
-        conn.execute("""
+async def job_retry(job_id: str):
+    now = now_ms()
+    async with app.state.pool.connection() as conn:
+        cursor = await conn.execute("""
             UPDATE jobs
             SET state='pending',
                 attempts=0,
                 next_run_at=NULL,
+                next_run_at_ms=NULL,
                 last_error=NULL,
-                updated_at=?
+                updated_at=?,
+                updated_at_ms=?
             WHERE id=?
-        """, (now_iso(), job_id))
+        """, (ms_to_iso(now), now, job_id))
+        await conn.commit()
+
+    if cursor.rowcount == 0:
+        return HTMLResponse("Job not found")
+
+    # Our own write: don't make the nav pages wait out the snapshot TTL
+    _state_cache["checked"] = 0.0
+    notify_workers()
 
     return HTMLResponse(f"""
     <html><head>{BASE_CSS}</head><body>
-    <h1>Job {job_id} requeued!</h1>
-    <a href='/job/{job_id}'>Back</a>
+    <h1>Job {html.escape(job_id)} requeued!</h1>
+    <a href='/job/{html.escape(job_id)}'>Back</a>
     </body></html>
     """)
 
@@ -370,27 +483,33 @@ def job_retry(job_id: str):
 #  TAIL LOGS
 # ============================================================
 @app.get("/job/{job_id}/tail", response_class=HTMLResponse)
-def job_tail(job_id: str):
-    with get_conn() as conn:
-        job = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+async def job_tail(job_id: str, request: Request):
+    job = await fetch_job(job_id)
 
     if not job:
         return HTMLResponse("Job not found")
 
-    output = (job["last_output"] or "").replace("<", "&lt;")
+    # Built from the same row that is rendered, so the tag always matches the body
+    etag = f'W/"{job[6]}"'
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    safe_id = html.escape(job[0])
+    output = html.escape(job[5] or "", quote=False)
 
-    html = f"""
+    page = f"""
     <html>
     <head>
         <meta http-equiv="refresh" content="2">
         {BASE_CSS}
     </head>
     <body>
-        <a href='/job/{job_id}'>← Back</a>
-        <h2>Tailing Logs for {job_id}</h2>
+        <a href='/job/{safe_id}'>← Back</a>
+        <h2>Tailing Logs for {safe_id}</h2>
 
         <div class='log-box'>{output}</div>
     </body></html>
     """
 
-    return html
+    return HTMLResponse(page, headers={"ETag": etag, **REVALIDATE_HEADERS})
@@ -1,31 +1,239 @@
 # flam/db.py
+import atexit
+import os
+import secrets
 import sqlite3
-from contextlib import contextmanager
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-import uuid
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+
+from flam.config import load_config
 
 DB_PATH = "queue.db"
 
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# journal_mode=WAL is persistent in the DB file, so it only needs to be set once per process
+_wal_set = False
+
+# One cached connection per thread (sqlite3 connections are not shareable across threads)
+_tls = threading.local()
+
+# ------------------------------------------------------------
+# SQL statements (each ORDER BY is served by an index from init_db)
+# ------------------------------------------------------------
+
+# Current time as computed inside SQLite, in the ISO display format and as epoch millis
+SQL_NOW_ISO = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+SQL_NOW_MS = "CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)"
+
+# idx_jobs_state_created_ms
+SQL_LIST_BY_STATE = """
+    SELECT id, command, attempts, max_retries, last_error, next_run_at
+    FROM jobs
+    WHERE state=?
+    ORDER BY created_at_ms
+"""
+
+# idx_jobs_state_updated_ms
+SQL_LIST_DEAD = """
+    SELECT id, command, attempts, last_error
+    FROM jobs
+    WHERE state='dead'
+    ORDER BY updated_at_ms DESC
+"""
+
+# One GROUP BY pass for every counter shown by `metrics` and the dashboard;
+# bind now_ms() for the scheduled count. See pivot_metrics().
+SQL_AGGREGATE_METRICS = """
+    SELECT state,
+           COUNT(*) AS count,
+           SUM(attempts) AS attempts,
+           COUNT(duration_seconds) AS timed,
+           SUM(duration_seconds) AS duration,
+           MIN(CASE WHEN duration_seconds > 0 THEN duration_seconds END) AS min_duration,
+           MAX(duration_seconds) AS max_duration,
+           SUM(CASE WHEN state='pending' AND next_run_at_ms > ? THEN 1 ELSE 0 END) AS scheduled
+    FROM jobs
+    GROUP BY state
+"""
+
+# idx_jobs_locked_at_ms (partial index on processing jobs)
+SQL_RECOVER_STUCK_SELECT = """
+    SELECT id FROM jobs
+    WHERE state='processing'
+    AND locked_at_ms IS NOT NULL
+    AND locked_at_ms < ?
+"""
+
+SQL_RECOVER_STUCK_UPDATE = """
+    UPDATE jobs
+    SET state='pending',
+        locked_by=NULL,
+        locked_at=NULL,
+        locked_at_ms=NULL,
+        updated_at=?,
+        updated_at_ms=?
+    WHERE state='processing'
+      AND locked_at_ms < ?
+"""
+
 def now_iso():
     """Return current UTC time in ISO format"""
     return datetime.utcnow().isoformat() + "Z"
 
+
+def now_ms():
+    """Return current UTC time as integer epoch milliseconds"""
+    return time.time_ns() // 1_000_000
+
+
+def ms_to_iso(ms):
+    """Format epoch milliseconds as an ISO-8601 UTC string (display columns)."""
+    dt = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def iso_to_ms(iso):
+    """Parse an ISO-8601 timestamp (naive means UTC) into epoch milliseconds."""
+    dt = datetime.fromisoformat(iso.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def _connection_pragmas():
+    """Return the PRAGMA statements to run on every new connection."""
+    global _wal_set
+    pragmas = []
+
+    if not _wal_set:
+        pragmas.append("PRAGMA journal_mode=WAL")
+        _wal_set = True
+
+    synchronous = str(load_config(create=False).get("sqlite_synchronous", "NORMAL")).upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        synchronous = "NORMAL"
+
+    pragmas += [
+        f"PRAGMA synchronous={synchronous}",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",  # 64MB page cache
+        "PRAGMA mmap_size=268435456",  # read pages through a 256MB memory map
+    ]
+    return pragmas
+
+
+def open_conn(check_same_thread=True):
+    """Open a new SQLite connection with the queue's pragmas applied."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    for pragma in _connection_pragmas():
+        conn.execute(pragma)
+    return conn
+
+
+async def open_async_conn():
+    """Open an aiosqlite connection (dashboard) with the queue's pragmas applied."""
+    import aiosqlite
+
+    conn = await aiosqlite.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    for pragma in _connection_pragmas():
+        await conn.execute(pragma)
+    return conn
+
+
+class ConnPool:
+    """
+    Fixed set of pre-opened aiosqlite connections for the dashboard, so concurrent
+    requests read in parallel under WAL instead of queueing on one connection.
+    """
+
+    def __init__(self, size=4, row_factory=sqlite3.Row):
+        self.size = size
+        self.row_factory = row_factory
+        self._idle = None
+
+    async def open(self):
+        import asyncio
+
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await open_async_conn()
+            conn.row_factory = self.row_factory
+            self._idle.put_nowait(conn)
+
+    async def get(self):
+        return await self._idle.get()
+
+    def put(self, conn):
+        self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+    async def close(self):
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+
+
+def _thread_conn():
+    """Return this thread's cached connection, opening it on first use."""
+    conn = getattr(_tls, "conn", None)
+    # A connection inherited across fork() must never be reused by the child
+    if conn is None or _tls.pid != os.getpid():
+        conn = open_conn()
+        _tls.conn = conn
+        _tls.pid = os.getpid()
+    return conn
+
+
 @contextmanager
 def get_conn():
-    """Context manager for SQLite connections."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    Context manager yielding this thread's SQLite connection; commits on a clean
+    exit and rolls back if the block raised, so a failed batch leaves nothing behind.
+    """
+    conn = _thread_conn()
     try:
         yield conn
-    finally:
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@atexit.register
+def close_conn():
+    """Close the calling thread's cached connection, if any."""
+    conn = getattr(_tls, "conn", None)
+    if conn is not None and _tls.pid == os.getpid():
+        try:
+            # Cheap: only re-analyzes tables whose stats look stale
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
         conn.commit()
         conn.close()
+    _tls.conn = None
+
+
+# STRICT tables (SQLite 3.37+) reject values of the wrong type instead of coercing them
+TABLE_OPTIONS = " STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
 
 
 def init_db():
     with get_conn() as conn:
-        conn.execute("""
+        conn.execute(f"""
         CREATE TABLE IF NOT EXISTS jobs (
             id TEXT PRIMARY KEY,
             command TEXT NOT NULL,
@@ -39,15 +247,18 @@ def init_db():
             locked_at TEXT,
             created_at TEXT NOT NULL,
             updated_at TEXT NOT NULL,
-            timeout_seconds INTEGER DEFAULT 30,       
-            priority INTEGER DEFAULT 0,               
-            last_output TEXT                          
+            next_run_at_ms INTEGER,
+            locked_at_ms INTEGER,
+            updated_at_ms INTEGER,
+            created_at_ms INTEGER,
+            timeout_seconds INTEGER DEFAULT 30,
+            priority INTEGER DEFAULT 0,
+            last_output TEXT,
             duration_seconds REAL
-
-        )
+        ){TABLE_OPTIONS}
         """)
 
-        # MIGRATIONS
+        # MIGRATIONS (only databases created by older versions are missing columns)
         columns = conn.execute("PRAGMA table_info(jobs)").fetchall()
         col_names = [col[1] for col in columns]
 
@@ -72,6 +283,49 @@ def init_db():
             conn.execute("ALTER TABLE jobs ADD COLUMN duration_seconds REAL;")
             print("Added missing column: duration_seconds")
 
+        # Integer epoch-millis mirrors of the ISO timestamps, used for all comparisons/sorting.
+        # The ISO columns are kept for display.
+        for ms_col, iso_col in (
+            ("next_run_at_ms", "next_run_at"),
+            ("locked_at_ms", "locked_at"),
+            ("updated_at_ms", "updated_at"),
+            ("created_at_ms", "created_at"),
+        ):
+            if ms_col not in col_names:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {ms_col} INTEGER;")
+                conn.execute(f"""
+                    UPDATE jobs
+                    SET {ms_col} = CAST(ROUND((julianday({iso_col}) - 2440587.5) * 86400000) AS INTEGER)
+                    WHERE {iso_col} IS NOT NULL
+                """)
+                print(f"Added missing column: {ms_col}")
+
+        # Bumped by every write to jobs: the dashboard's ETag and snapshot cache key on
+        # it, since updated_at_ms can repeat within a millisecond or step back with the clock
+        conn.execute(f"CREATE TABLE IF NOT EXISTS jobs_version (version INTEGER NOT NULL){TABLE_OPTIONS}")
+        conn.execute("INSERT INTO jobs_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM jobs_version)")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS jobs_version_{event.lower()} AFTER {event} ON jobs
+                BEGIN UPDATE jobs_version SET version = version + 1; END
+            """)
+
+        # INDEXES
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_next_run_ms ON jobs(state, next_run_at_ms);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_updated_ms ON jobs(state, updated_at_ms DESC);")
+        # Claim order for the worker's hot path; only pending rows are indexed
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_pending_ms ON jobs(priority DESC, created_at_ms ASC, next_run_at_ms) "
+            "WHERE state='pending';"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_locked_at_ms ON jobs(state, locked_at_ms) WHERE state='processing';")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_created_ms ON jobs(state, created_at_ms);")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated_ms ON jobs(updated_at_ms DESC);")
+
+        # Give the planner stats for the new indexes (bounded cost on large tables)
+        conn.execute("PRAGMA analysis_limit=1000;")
+        conn.execute("PRAGMA optimize;")
+
 
     init_config()
     print("Database initialized successfully at", DB_PATH)
@@ -82,31 +336,59 @@ def enqueue_job(command, timeout_seconds=30, priority=0, next_run_at=None):
     """
     Insert job into DB. next_run_at must be an ISO string with Z (UTC) or None for ASAP.
     """
-    job_id = uuid.uuid4().hex[:8]
-    now = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat().replace("+00:00", "Z")
+    return enqueue_jobs_bulk([(command, timeout_seconds, priority, next_run_at)])[0]
 
-    with get_conn() as conn:
-        conn.execute("""
-            INSERT INTO jobs (
-                id, command, state, attempts, max_retries, base_backoff,
-                next_run_at, last_error, locked_by, locked_at,
-                created_at, updated_at,
-                timeout_seconds, priority, last_output
-            )
-            VALUES (?, ?, 'pending', 0, ?, ?, ?, NULL, NULL, NULL, ?, ?, ?, ?, ?)
-        """, (
+
+def enqueue_jobs_bulk(jobs: list[tuple]) -> list[str]:
+    """
+    Insert many jobs in a single transaction.
+    Each entry is (command, timeout_seconds, priority, next_run_at); returns the new job ids.
+    """
+    now = now_ms()
+    now_str = ms_to_iso(now)
+
+    job_ids = []
+    rows = []
+    for command, timeout_seconds, priority, next_run_at in jobs:
+        job_id = secrets.token_hex(4)
+        job_ids.append(job_id)
+        rows.append((
             job_id,
             command,
             3,                     # default max_retries (you can replace or read config)
             2.0,                   # default base_backoff
             next_run_at,
+            iso_to_ms(next_run_at) if next_run_at else None,
+            now_str,
             now,
+            now_str,
             now,
             timeout_seconds,
             priority,
             None                   # last_output
         ))
-    return job_id
+
+    with get_conn() as conn:
+        conn.execute("BEGIN")
+        conn.executemany("""
+            INSERT INTO jobs (
+                id, command, state, attempts, max_retries, base_backoff,
+                next_run_at, next_run_at_ms, last_error, locked_by, locked_at,
+                created_at, created_at_ms, updated_at, updated_at_ms,
+                timeout_seconds, priority, last_output
+            )
+            VALUES (?, ?, 'pending', 0, ?, ?, ?, ?, NULL, NULL, NULL, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+    return job_ids
+
+def compact_db():
+    """Rebuild the DB file to reclaim free pages and truncate the WAL."""
+    with get_conn() as conn:
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
 
 def get_job_counts():
     """Return a count of jobs grouped by state."""
@@ -119,32 +401,74 @@ def get_job_counts():
     return {r["state"]: r["count"] for r in rows}
 
 
+def get_aggregate_metrics():
+    """Return queue-wide metrics computed in a single pass over the jobs table."""
+    with get_conn() as conn:
+        rows = conn.execute(SQL_AGGREGATE_METRICS, (now_ms(),)).fetchall()
+    return pivot_metrics(rows)
+
+
+def pivot_metrics(rows):
+    """Fold the per-state rows of SQL_AGGREGATE_METRICS into one metrics dict."""
+    metrics = {
+        "total": 0,
+        "pending": 0,
+        "processing": 0,
+        "completed": 0,
+        "dead": 0,
+        "scheduled": 0,
+        "total_retries": 0,
+        "avg_retries": 0,
+        "avg_duration": 0,
+        "min_duration": 0,
+        "max_duration": 0,
+    }
+    timed = 0
+    total_duration = 0
+    min_durations = []
+    max_durations = []
+
+    for state, count, attempts, state_timed, duration, min_duration, max_duration, scheduled in rows:
+        metrics[state] = count
+        metrics["total"] += count
+        metrics["scheduled"] += scheduled or 0
+        metrics["total_retries"] += attempts or 0
+        timed += state_timed
+        total_duration += duration or 0
+        if min_duration is not None:
+            min_durations.append(min_duration)
+        if max_duration is not None:
+            max_durations.append(max_duration)
+
+    if metrics["total"]:
+        metrics["avg_retries"] = metrics["total_retries"] / metrics["total"]
+    if timed:
+        metrics["avg_duration"] = total_duration / timed
+    if min_durations:
+        metrics["min_duration"] = min(min_durations)
+    if max_durations:
+        metrics["max_duration"] = max(max_durations)
+
+    return metrics
+
+
 def list_jobs_by_state(state: str):
     """Return all jobs in a given state."""
     with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT id, command, attempts, max_retries, last_error
-            FROM jobs
-            WHERE state=?
-            ORDER BY created_at
-        """, (state,)).fetchall()
+        rows = conn.execute(SQL_LIST_BY_STATE, (state,)).fetchall()
     return rows
 
 
 def list_dead_jobs():
     """Return all jobs in Dead Letter Queue."""
     with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT id, command, attempts, last_error
-            FROM jobs
-            WHERE state='dead'
-            ORDER BY updated_at DESC
-        """).fetchall()
+        rows = conn.execute(SQL_LIST_DEAD).fetchall()
     return rows
 
 
 def retry_dead_job(job_id: str):
     """Move a dead job back to pending for re-execution."""
+    now = now_ms()
     with get_conn() as conn:
         job = conn.execute(
             "SELECT id FROM jobs WHERE id=? AND state='dead'", (job_id,)
@@ -156,10 +480,13 @@ def retry_dead_job(job_id: str):
             SET state='pending',
                 attempts=0,
                 next_run_at=NULL,
+                next_run_at_ms=NULL,
                 last_error=NULL,
-                updated_at=?
+                updated_at=?,
+                updated_at_ms=?
             WHERE id=?
-        """, (now_iso(), job_id))
+        """, (ms_to_iso(now), now, job_id))
+
     return True
 
 
@@ -195,28 +522,14 @@ def recover_stuck_jobs(timeout_seconds=60):
     """
     Move jobs stuck in 'processing' back to 'pending'.
     """
-    now = datetime.utcnow()
-    cutoff = now - timedelta(seconds=timeout_seconds)
-    cutoff_iso = cutoff.isoformat() + "Z"
+    now = now_ms()
+    cutoff = now - timeout_seconds * 1000
 
     with get_conn() as conn:
         # Find stuck jobs
-        stuck = conn.execute("""
-            SELECT id FROM jobs
-            WHERE state='processing'
-            AND locked_at IS NOT NULL
-            AND locked_at < ?
-        """, (cutoff_iso,)).fetchall()
+        stuck = conn.execute(SQL_RECOVER_STUCK_SELECT, (cutoff,)).fetchall()
 
         # Requeue them
-        conn.execute("""
-            UPDATE jobs
-            SET state='pending',
-                locked_by=NULL,
-                locked_at=NULL,
-                updated_at=?
-            WHERE state='processing'
-              AND locked_at < ?
-        """, (now_iso(), cutoff_iso))
+        conn.execute(SQL_RECOVER_STUCK_UPDATE, (ms_to_iso(now), now, cutoff))
 
     return [row["id"] for row in stuck]
@@ -0,0 +1,62 @@
+# flam/utils.py
+# Worker wake-ups: enqueue fires a UDP datagram at 127.0.0.1, worker-start listens
+# for it and forwards SIGUSR1 to its workers, so an idle worker picks a new job up
+# immediately instead of on its next poll. The poll stays as a fallback, and a
+# datagram nobody is listening for is simply dropped.
+import socket
+import threading
+
+from flam.config import DEFAULT_CONFIG, load_config
+
+WAKEUP_HOST = "127.0.0.1"
+
+_wakeup_port = None
+
+
+def wakeup_port():
+    """The configured wake-up port, read from config once per process (default if invalid)."""
+    global _wakeup_port
+    if _wakeup_port is None:
+        try:
+            port = int(load_config(create=False).get("wakeup_port", DEFAULT_CONFIG["wakeup_port"]))
+        except (TypeError, ValueError):
+            port = None
+        # socket calls raise OverflowError, not OSError, for ports outside this range
+        if port is None or not 0 < port < 65536:
+            port = DEFAULT_CONFIG["wakeup_port"]
+        _wakeup_port = port
+    return _wakeup_port
+
+
+def _wakeup_addr():
+    return WAKEUP_HOST, wakeup_port()
+
+
+def notify_workers():
+    """Tell a running worker-start that new work is ready (best effort)."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"1", _wakeup_addr())
+    except OSError:
+        pass
+
+
+def serve_wakeups(on_wake):
+    """
+    Call on_wake() for every wake-up datagram, from a daemon thread.
+    Returns False if the port can't be bound (e.g. another worker-start has it).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(_wakeup_addr())
+    except OSError:
+        sock.close()
+        return False
+
+    def loop():
+        while True:
+            sock.recv(16)
+            on_wake()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return True
@@ -1,170 +1,445 @@
+import functools
+import random
+import shlex
 import sqlite3
 import subprocess
 import time
 import uuid
-from datetime import datetime, timedelta
-from flam.db import get_conn, now_iso, DB_PATH
+from flam.config import load_config
+from flam.db import open_conn, SQL_NOW_ISO, SQL_NOW_MS, DB_PATH
 import os
+import queue
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 WORKER_ID = str(uuid.uuid4())[:8]
 
+MAX_BACKOFF_EXPONENT = 20
+MAX_BACKOFF_SECONDS = 3600
 
-def claim_one_job():
+# Commands containing any of these go through /bin/sh; the rest are exec'd directly
+SHELL_METACHARS = frozenset("|&;<>()$`\\*?[]{}~#!=%\n")
+
+# Job output kept in memory: the last lines, each capped, joined and cut to what's stored
+OUTPUT_TAIL_LINES = 200
+OUTPUT_LINE_CHARS = 8192
+OUTPUT_TAIL_CHARS = 5000
+
+# Long-lived workers refresh planner stats and trim the WAL this often
+MAINTENANCE_INTERVAL = 900
+
+
+# Attempts per statement when the database stays locked past busy_timeout
+LOCKED_RETRIES = 3
+# What the signal handlers queue for worker_loop
+WAKE, STOP = "wake", "stop"
+
+# UPDATE ... RETURNING (SQLite 3.35+) claims in one statement instead of SELECT + UPDATE
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Hot-path statements as module constants: one literal each, so every call hits
+# the connection's statement cache with identical text. Timestamps come from
+# SQLite's own clock ('now' is fixed for the whole statement), so the ISO and
+# millisecond columns always agree and nothing is formatted in Python.
+SQL_CLAIM_JOBS = f"""
+    UPDATE jobs
+    SET state='processing',
+        locked_by=?,
+        locked_at={SQL_NOW_ISO},
+        locked_at_ms={SQL_NOW_MS},
+        updated_at={SQL_NOW_ISO},
+        updated_at_ms={SQL_NOW_MS}
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE state='pending'
+          AND (next_run_at_ms IS NULL OR next_run_at_ms <= {SQL_NOW_MS})
+        ORDER BY priority DESC, created_at_ms ASC
+        LIMIT ?
+    )
+    RETURNING id, command, attempts, max_retries, base_backoff, timeout_seconds, priority, created_at_ms
+"""
+
+SQL_CLAIM_SELECT = f"""
+    SELECT id, command, attempts, max_retries, base_backoff, timeout_seconds, priority
+    FROM jobs
+    WHERE state='pending'
+      AND (next_run_at_ms IS NULL OR next_run_at_ms <= {SQL_NOW_MS})
+    ORDER BY priority DESC, created_at_ms ASC
+    LIMIT 1
+"""
+
+SQL_CLAIM_UPDATE = f"""
+    UPDATE jobs
+    SET state='processing',
+        locked_by=?,
+        locked_at={SQL_NOW_ISO},
+        locked_at_ms={SQL_NOW_MS},
+        updated_at={SQL_NOW_ISO},
+        updated_at_ms={SQL_NOW_MS}
+    WHERE id=? AND state='pending'
+"""
+
+SQL_JOB_SUCCESS = f"""
+    UPDATE jobs
+    SET state='completed',
+        last_output=?,
+        duration_seconds=?,
+        updated_at={SQL_NOW_ISO},
+        updated_at_ms={SQL_NOW_MS}
+    WHERE id=?
+"""
+
+# One statement for both failure outcomes: past max_retries the job goes to the DLQ,
+# otherwise it is rescheduled :delay_ms from now
+SQL_JOB_FAILURE = f"""
+    UPDATE jobs
+    SET attempts=:attempts,
+        state=CASE WHEN :attempts > max_retries THEN 'dead' ELSE 'pending' END,
+        next_run_at=CASE WHEN :attempts > max_retries THEN next_run_at
+            ELSE strftime('%Y-%m-%dT%H:%M:%fZ', ({SQL_NOW_MS} + :delay_ms) / 1000.0, 'unixepoch') END,
+        next_run_at_ms=CASE WHEN :attempts > max_retries THEN next_run_at_ms
+            ELSE {SQL_NOW_MS} + :delay_ms END,
+        last_error=CASE WHEN :attempts > max_retries THEN 'Max retries exceeded' ELSE 'Job failed' END,
+        last_output=:output,
+        duration_seconds=:duration,
+        updated_at={SQL_NOW_ISO},
+        updated_at_ms={SQL_NOW_MS}
+    WHERE id=:id
+"""
+
+
+def retry_if_locked(fn):
+    """
+    Retry fn with a short exponential backoff when SQLite still reports the database
+    locked after busy_timeout; any other error, or the last attempt's, is raised.
+    Each wrapped helper runs in its own 'with conn:' transaction, so a retry starts clean.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(LOCKED_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == LOCKED_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+    return wrapper
+
+
+def claim_one_job(conn):
     """Atomically pick one pending job ready to run and lock it."""
-    with get_conn() as conn:
+    jobs = claim_jobs(conn, 1)
+    return jobs[0] if jobs else None
+
+
+def claim_jobs(conn, n):
+    """Atomically lock up to n pending jobs ready to run; returns their sqlite3.Rows in claim order."""
+    if not HAS_RETURNING:
+        jobs = []
+        for _ in range(n):
+            try:
+                job = _claim_one_job_select(conn)
+            except Exception:
+                if not jobs:
+                    raise
+                # Hand back the jobs already locked rather than stranding them
+                break
+            if not job:
+                break
+            jobs.append(job)
+        return jobs
+
+    return _claim_jobs_returning(conn, n)
+
+
+@retry_if_locked
+def _claim_jobs_returning(conn, n):
+    with conn:
+        # A write statement takes the write lock before it reads, so the
+        # subquery can't pick a row another worker is claiming.
+        rows = conn.execute(SQL_CLAIM_JOBS, (WORKER_ID, n)).fetchall()
+
+    # RETURNING order is unspecified; restore the claim order
+    return sorted(rows, key=lambda job: (-job["priority"], job["created_at_ms"]))
+
+
+@retry_if_locked
+def _claim_one_job_select(conn):
+    """claim_one_job for SQLite builds without RETURNING."""
+    with conn:
         conn.execute("BEGIN IMMEDIATE")
-        row = conn.execute(
-            """
-            SELECT id, command, attempts, max_retries, base_backoff, timeout_seconds, priority
-FROM jobs
-WHERE state='pending'
-  AND (next_run_at IS NULL OR next_run_at <= ?)
-ORDER BY priority DESC, created_at ASC
-LIMIT 1
-
-            """,
-            (now_iso(),)
-        ).fetchone()
+        row = conn.execute(SQL_CLAIM_SELECT).fetchone()
 
         if not row:
             conn.execute("COMMIT")
             return None
 
-        conn.execute("""
-            UPDATE jobs
-            SET state='processing',
-                locked_by=?,
-                locked_at=?,
-                updated_at=?
-            WHERE id=? AND state='pending'
-        """, (WORKER_ID, now_iso(), now_iso(), row["id"]))
+        conn.execute(SQL_CLAIM_UPDATE, (WORKER_ID, row["id"]))
 
         conn.execute("COMMIT")
-        return dict(row)
+        return row
 
 
-def run_command(cmd, timeout_seconds):
-    """Execute the job command with timeout and capture output cleanly."""
+def _read_tail(stream, tail):
+    # readline(limit) bounds even a single huge line
+    for line in iter(lambda: stream.readline(OUTPUT_LINE_CHARS), ""):
+        tail.append(line)
+
+
+def _popen(args, shell):
+    return subprocess.Popen(
+        args,
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+
+
+def _spawn(cmd):
+    """
+    Plain commands are exec'd directly from their shlex-split argv, skipping the
+    /bin/sh -c hop. Anything needing the shell (pipes, redirects, globs, variables,
+    builtins) and every command on Windows still runs with shell=True.
+    """
+    if os.name == "nt" or any(c in SHELL_METACHARS for c in cmd):
+        return _popen(cmd, shell=True)
+
     try:
-        completed = subprocess.run(
-            cmd,
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=timeout_seconds
-        )
-        return (
-            completed.returncode,
-            completed.stdout or "",
-            completed.stderr or ""
-        )
+        args = shlex.split(cmd)
+    except ValueError:
+        # e.g. unbalanced quotes: let the shell report it
+        return _popen(cmd, shell=True)
+
+    try:
+        return _popen(args, shell=False)
+    except OSError:
+        # Not an executable (a shell builtin, or missing): the shell handles it and
+        # keeps its usual exit codes and messages, e.g. 127 "not found"
+        return _popen(cmd, shell=True)
 
-    except subprocess.TimeoutExpired:
-        # Return standard timeout exit code (124) + error message
-        return 124, "", f"Timeout after {timeout_seconds} seconds"
 
+def run_command(cmd, timeout_seconds):
+    """
+    Execute the job command with timeout. stdout and stderr are interleaved and only
+    the last OUTPUT_TAIL_LINES lines are kept, so a chatty command can't grow memory.
+    """
+    try:
+        proc = _spawn(cmd)
     except Exception as e:
-        # Any unexpected exception during subprocess
+        # Any unexpected exception starting the subprocess
         return 1, "", str(e)
 
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    reader = threading.Thread(target=_read_tail, args=(proc.stdout, tail), daemon=True)
+    reader.start()
+
+    deadline = time.monotonic() + timeout_seconds
+    try:
+        code = proc.wait(timeout=timeout_seconds)
+        # A background grandchild can keep the pipe open after the command itself
+        # exits; the job's timeout still covers draining it
+        reader.join(max(0, deadline - time.monotonic()))
+        timed_out = reader.is_alive()
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        # A grandchild may still hold the pipe open; don't wait on it for long
+        reader.join(1)
+        timed_out = True
+
+    if timed_out:
+        # Return standard timeout exit code (124) + error message
+        return 124, "".join(tail.copy())[-OUTPUT_TAIL_CHARS:], f"Timeout after {timeout_seconds} seconds"
+
+    return code, "".join(tail)[-OUTPUT_TAIL_CHARS:], ""
 
 
-def update_job_success(job_id, output, duration):
-    with get_conn() as conn:
-        conn.execute(
-            """
-            UPDATE jobs
-            SET state='completed',
-                last_output=?,
-                duration_seconds=?,
-                updated_at=?
-            WHERE id=?
-            """,
-            (output[:5000], duration, now_iso(), job_id)
-        )
+@retry_if_locked
+def update_job_success(conn, job_id, output, duration):
+    with conn:
+        conn.execute(SQL_JOB_SUCCESS, (output[-OUTPUT_TAIL_CHARS:], duration, job_id))
 
 
-def update_job_failure(job, output,duration):
+@retry_if_locked
+def update_job_failure(conn, job, output, duration):
     """Handle job failure → retry or DLQ."""
     attempts = job["attempts"] + 1
-    now = now_iso()
-
-    # Compute exponential backoff
-    next_run = (
-        datetime.utcnow() + timedelta(seconds=job["base_backoff"] ** attempts)
-    ).replace(tzinfo=None).isoformat() + "Z"
-
-    with get_conn() as conn:
-        # Move to DLQ if retries exceeded
-        if attempts > job["max_retries"]:
-            conn.execute(
-                """
-                UPDATE jobs
-                SET state='dead',
-                    attempts=?,
-                    last_error=?,
-                    last_output=?,
-                    duration_seconds=?,
-                    updated_at=?
-                WHERE id=?
-                """,
-                (attempts, "Max retries exceeded", output[:5000], duration,now, job["id"])
-            )
-        else:
-            # Retry again
-            conn.execute(
-                """
-                UPDATE jobs
-                SET state='pending',
-                    attempts=?,
-                    next_run_at=?,
-                    last_error=?,
-                    last_output=?,
-                    duration_seconds=?,
-                    updated_at=?
-                WHERE id=?
-                """,
-                (attempts, next_run, "Job failed", output[:5000],duration, now, job["id"])
-            )
-
-
-def worker_loop(poll_interval=1):
-    print(f"Worker {WORKER_ID} started")
-    start = time.time()
+
+    # Exponential backoff, saturated so a large base or attempt count can't overflow,
+    # plus up to 10% jitter so jobs that failed together don't retry together
+    delay = min(job["base_backoff"] ** min(attempts, MAX_BACKOFF_EXPONENT), MAX_BACKOFF_SECONDS)
+    delay += random.uniform(0, delay * 0.1)
+
+    with conn:
+        conn.execute(SQL_JOB_FAILURE, {
+            "id": job["id"],
+            "attempts": attempts,
+            "delay_ms": int(delay * 1000),
+            "output": output[-OUTPUT_TAIL_CHARS:],
+            "duration": duration,
+        })
+
+
+def run_maintenance(conn):
+    """Periodic PRAGMA optimize + WAL truncation; a failure here never stops the worker."""
+    try:
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    except sqlite3.Error as e:
+        print(f"[{WORKER_ID}] Maintenance skipped: {e}")
+
+
+def run_job(job):
+    """Run one claimed job on a pool thread; returns what the DB writer needs."""
+    jid = job["id"]
+    cmd = job["command"]
+    timeout_sec = job["timeout_seconds"] or 30
+
+    print(f"[{WORKER_ID}] Running {jid}: {cmd} (timeout={timeout_sec}s)")
+
+    start = time.monotonic()
+    code, out, err = run_command(cmd, timeout_sec)
+    duration = time.monotonic() - start
+    # Combine logs safely
+    combined_output = (out or "") + (err or "")
+    return job, code, combined_output, duration
+
+
+def write_results(results):
+    """
+    DB-writer thread: records finished jobs in completion order. SQLite serializes
+    writes anyway, so one thread with its own connection does all of them.
+    """
+    conn = open_conn()
     while True:
-        # Stop flag check
-        if os.path.exists("stop.flag"):
-            print(f"[{WORKER_ID}] Stop flag detected. Exiting gracefully.")
+        item = results.get()
+        if item is None:
             break
 
-        job = claim_one_job()
-        if not job:
-            time.sleep(poll_interval)
-            continue
-
+        job, code, combined_output, duration = item
         jid = job["id"]
-        cmd = job["command"]
-        timeout_sec = job.get("timeout_seconds", 30)
+        try:
+            if code == 0:
+                # SUCCESS
+                print(f"[{WORKER_ID}] Job {jid} completed")
+                update_job_success(conn, jid, combined_output, duration)
+
+            else:
+                # FAILURE
+                print(
+                    f"[{WORKER_ID}] Job {jid} failed (attempt {job['attempts'] + 1})"
+                )
+                update_job_failure(conn, job, combined_output or "Unknown error", duration)
+        except Exception as e:
+            # Left in 'processing'; recover_stuck_jobs requeues it on the next worker-start
+            print(f"[{WORKER_ID}] Could not record result of {jid}: {e}")
+    conn.close()
+
+
+def worker_concurrency():
+    """Jobs one worker process runs at once (config worker_concurrency, 0 = one per CPU)."""
+    try:
+        concurrency = int(load_config(create=False).get("worker_concurrency", 1))
+    except (TypeError, ValueError):
+        concurrency = 1
+    if concurrency <= 0:
+        concurrency = os.cpu_count() or 1
+    return concurrency
+
+
+def worker_loop(use_signals=False, poll_interval=1):
+    """
+    Claim and run jobs until told to stop.
+    With use_signals, SIGTERM (sent by worker-stop / worker-start) requests a graceful
+    stop and no filesystem polling is done; otherwise the worker watches for stop.flag.
+    Commands run on a thread pool; jobs already running are finished before exiting.
+    """
+    # Forked workers inherit the parent's module state, so pick a fresh id per process
+    global WORKER_ID
+    WORKER_ID = str(uuid.uuid4())[:8]
+
+    # Signal handlers only ever put_nowait() here, which SimpleQueue allows from a
+    # handler; Event.set() could block forever on a lock the interrupted loop holds
+    wakeups = queue.SimpleQueue()
+
+    def drain_wakeups(timeout=None):
+        """Consume queued wake-ups, waiting up to timeout for the first; True if one was a stop."""
+        stop = False
+        try:
+            item = wakeups.get(block=timeout is not None, timeout=timeout)
+            while True:
+                stop = stop or item == STOP
+                item = wakeups.get_nowait()
+        except queue.Empty:
+            pass
+        return stop
+
+    if use_signals:
+        signal.signal(signal.SIGTERM, lambda signum, frame: wakeups.put_nowait(STOP))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: wakeups.put_nowait(WAKE))
+        # Ctrl+C reaches the whole process group; the parent forwards it as SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    concurrency = worker_concurrency()
+    # Claims happen on this thread's connection; results go through the writer's
+    conn = open_conn()
+    results = queue.Queue()
+    writer = threading.Thread(target=write_results, args=(results,), daemon=True)
+    writer.start()
+    free_slots = threading.Semaphore(concurrency)
+
+    def finished(future):
+        try:
+            results.put(future.result())
+        except Exception as e:
+            print(f"[{WORKER_ID}] Job crashed before its result was recorded: {e}")
+        finally:
+            free_slots.release()
+
+    last_maintenance = time.monotonic()
+    stopping = False
 
-        print(f"[{WORKER_ID}] Running {jid}: {cmd} (timeout={timeout_sec}s)")
+    print(f"Worker {WORKER_ID} started (concurrency={concurrency})")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            # A wake-up queued before this pass is answered by the claim below
+            stopping = drain_wakeups() or stopping
+            if stopping:
+                print(f"[{WORKER_ID}] Stop requested. Exiting gracefully.")
+                break
+            if not use_signals and os.path.exists("stop.flag"):
+                print(f"[{WORKER_ID}] Stop flag detected. Exiting gracefully.")
+                break
 
-        # Run the command
-        code, out, err = run_command(cmd, timeout_sec)
-        duration = time.time() - start
-        # Combine logs safely
-        combined_output = (out or "") + (err or "")
+            if time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                run_maintenance(conn)
+                last_maintenance = time.monotonic()
 
-        if code == 0:
-            # SUCCESS
-            print(f"[{WORKER_ID}] Job {jid} completed")
-            update_job_success(jid, combined_output,duration)
+            # Only claim when a pool thread is free, then take every free slot at once
+            if not free_slots.acquire(timeout=poll_interval):
+                continue
+            slots = 1
+            while slots < concurrency and free_slots.acquire(blocking=False):
+                slots += 1
 
-        else:
-            # FAILURE
-            print(
-                f"[{WORKER_ID}] Job {jid} failed (attempt {job['attempts'] + 1})"
-            )
-            update_job_failure(job, combined_output or "Unknown error",duration)
+            try:
+                jobs = claim_jobs(conn, slots)
+            except Exception as e:
+                print(f"[{WORKER_ID}] Claim failed, retrying next poll: {e}")
+                jobs = []
+            for _ in range(slots - len(jobs)):
+                free_slots.release()
+            if not jobs:
+                stopping = drain_wakeups(poll_interval)
+                continue
 
-        time.sleep(0.2)
+            for job in jobs:
+                pool.submit(run_job, job).add_done_callback(finished)
 
+    results.put(None)
+    writer.join()
+    conn.close()
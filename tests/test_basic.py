@@ -2,6 +2,7 @@ import subprocess
 import time
 import sqlite3
 import os
+import sys
 from datetime import datetime, timedelta
 
 DB_PATH = "queue.db"
@@ -19,6 +20,16 @@ def run(cmd):
     return result.stdout.strip()
 
 
+# Enqueue several jobs with one CLI call; returns their ids in line order
+def enqueue_many(*lines):
+    with open("jobs.txt", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    out = run("python -m flam.cli enqueue-many --from-file jobs.txt")
+    os.remove("jobs.txt")
+    print(out)
+    return [line.split()[2].replace(":", "") for line in out.splitlines() if line.startswith("Enqueued job")]
+
+
 print("\n===== TEST 1: INIT DB =====")
 
 if os.path.exists(DB_PATH):
@@ -33,12 +44,36 @@ print("✔ DB initialized")
 
 print("\n===== TEST 2: ENQUEUE JOB =====")
 
-out = run('python -m flam.cli enqueue "echo hello"')
-print(out)
-job_id = out.split()[2].replace(":", "")
+# The invalid job is used by TEST 4; enqueueing both here saves an interpreter start
+job_id, dead_id = enqueue_many("echo hello", "invalid_command_123")
 print("✔ Enqueue OK / Job =", job_id)
 
 
+print("\n===== TEST 2b: FAILING BATCH IS ROLLED BACK =====")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flam import db as flam_db
+
+# Force a duplicate id on the third row so the INSERT fails partway through the batch
+fake_ids = iter(["batch001", "batch002", "batch002", "batch003"])
+real_token_hex = flam_db.secrets.token_hex
+flam_db.secrets.token_hex = lambda nbytes: next(fake_ids)
+try:
+    flam_db.enqueue_jobs_bulk([("echo BATCH", 30, 0, None)] * 4)
+    raise AssertionError("Duplicate id in batch did not raise")
+except sqlite3.IntegrityError:
+    pass
+finally:
+    flam_db.secrets.token_hex = real_token_hex
+    flam_db.close_conn()
+
+check = sqlite3.connect(DB_PATH)
+leftover = check.execute("SELECT COUNT(*) FROM jobs WHERE id LIKE 'batch%'").fetchone()[0]
+check.close()
+assert leftover == 0, f"Failed batch left {leftover} row(s) behind"
+print("✔ Failed batch left no rows")
+
+
 print("\n===== TEST 3: WORKER PROCESSING =====")
 
 p = subprocess.Popen("python -m flam.cli worker-start --count 1", shell=True)
@@ -58,21 +93,19 @@ print("\n===== TEST 4: INVALID → DLQ =====")
 run("python -m flam.cli init")
 time.sleep(0.3)
 
-out = run('python -m flam.cli enqueue "invalid_command_123"')
-print(out)
-dead_id = out.split()[2].replace(":", "")
-
 p = subprocess.Popen("python -m flam.cli worker-start --count 1", shell=True)
 
 deadline = time.time() + 20
 state = None
 
 while time.time() < deadline:
+    # End any open read transaction so each poll sees the worker's latest commit
+    con.commit()
     row = con.execute("SELECT state FROM jobs WHERE id=?", (dead_id,)).fetchone()
     if row and row[0] == "dead":
         state = "dead"
         break
-    time.sleep(1)
+    time.sleep(0.1)
 
 p.terminate()
 
@@ -96,8 +129,7 @@ print("\n===== BONUS TEST: PRIORITY ORDERING =====")
 os.remove(DB_PATH)
 run("python -m flam.cli init")
 
-run('python -m flam.cli enqueue "echo LOW" --priority 1')
-run('python -m flam.cli enqueue "echo HIGH" --priority 10')
+enqueue_many("--priority 1 echo LOW", "--priority 10 echo HIGH")
 
 p = subprocess.Popen("python -m flam.cli worker-start --count 1", shell=True)
 time.sleep(3)
@@ -128,29 +160,35 @@ p.terminate()
 print("✔ Scheduled jobs wait until the correct timestamp")
 
 
-print("\n===== BONUS TEST: TIMEOUT HANDLING =====")
+print("\n===== BONUS TEST: BULK ENQUEUE =====")
 
-out = run('python -m flam.cli enqueue "timeout /T 5" --timeout 1')
-timeout_id = out.split()[2].replace(":", "")
+bulk_ids = enqueue_many("echo BULK_1", "echo BULK_2", "", "--priority 7 echo BULK_3")
+assert len(bulk_ids) == 3, "Bulk enqueue failed"
+
+con.commit()
+rows = con.execute(
+    f"SELECT command, priority FROM jobs WHERE id IN ({','.join('?' * len(bulk_ids))}) ORDER BY command",
+    bulk_ids,
+).fetchall()
+assert [(r["command"], r["priority"]) for r in rows] == [
+    ("echo BULK_1", 0), ("echo BULK_2", 0), ("echo BULK_3", 7)
+], "Bulk jobs not stored with their per-line options"
+print("✔ Bulk enqueue works")
+
+
+print("\n===== BONUS TEST: TIMEOUT HANDLING + OUTPUT LOGGING =====")
+
+timeout_id, log_id = enqueue_many("--timeout 1 timeout /T 5", "echo LOG_OUTPUT_TEST")
 
 p = subprocess.Popen("python -m flam.cli worker-start --count 1", shell=True)
 time.sleep(4)
 p.terminate()
 
+con.commit()
 row = con.execute("SELECT last_error FROM jobs WHERE id=?", (timeout_id,)).fetchone()
 assert "Timeout" in (row[0] or ""), "Timeout was not detected"
 print("✔ Timeout killing works")
 
-
-print("\n===== BONUS TEST: OUTPUT LOGGING =====")
-
-out = run('python -m flam.cli enqueue "echo LOG_OUTPUT_TEST"')
-log_id = out.split()[2].replace(":", "")
-
-p = subprocess.Popen("python -m flam.cli worker-start --count 1", shell=True)
-time.sleep(2)
-p.terminate()
-
 row = con.execute("SELECT last_output FROM jobs WHERE id=?", (log_id,)).fetchone()
 assert "LOG_OUTPUT_TEST" in (row[0] or ""), "Output not logged into DB"
 